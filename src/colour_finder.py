@@ -7,14 +7,30 @@ Author: Mohammed Alkhateeb (@MoAlkhateeb)
 """
 
 import io
+import math
+import inspect
+import weakref
 from pathlib import Path
-from collections import Counter
 from typing import Callable, Optional
-from PIL import Image, ImageColor, ImageEnhance
+
+import numpy as np
+from PIL import Image, ImageColor, ImageStat
 
 RGBPixel = tuple[int, int, int]
 PathLike = str | Path
 
+# images much larger than this are downsampled before looking for colours
+MAX_PIXELS = 200_000
+
+# compiled weight kernels for custom callbacks, None if a callback can't be compiled.
+# Keys are weak, so a kernel is dropped along with its callback.
+_JIT_KERNELS: weakref.WeakKeyDictionary[
+    Callable[[RGBPixel], float], Optional[Callable[[np.ndarray], np.ndarray]]
+] = weakref.WeakKeyDictionary()
+
+# custom callbacks seen once, which are only compiled if they are used again
+_SEEN_CALLBACKS: weakref.WeakSet[Callable[[RGBPixel], float]] = weakref.WeakSet()
+
 
 class ColorFinder:
     """
@@ -26,7 +42,18 @@ class ColorFinder:
         self,
         image: Image.Image,
         color_factor_callback: Callable[[RGBPixel], float] | None = None,
+        max_pixels: Optional[int] = MAX_PIXELS,
     ):
+        """
+        If `max_pixels` is given, larger images are downsampled by an integer factor
+        to roughly that size, as the prominent colours do not need full resolution.
+
+        `max_pixels` is a soft target rather than a limit: the factor is rounded down
+        so images are never reduced below it, which leaves images of up to about four
+        times `max_pixels` at full size.
+        """
+        if max_pixels is not None and max_pixels <= 0:
+            raise ValueError("max_pixels Must be a Positive Number of Pixels.")
 
         self.callback: Callable[[RGBPixel], float]
 
@@ -35,9 +62,55 @@ class ColorFinder:
         else:
             self.callback = color_factor_callback
 
-        self.image = image.convert("RGB")
+        self.image = image if image.mode == "RGB" else image.convert("RGB")
+
+        if max_pixels is not None:
+            factor = int(math.sqrt(self.image.width * self.image.height / max_pixels))
+            if factor > 1:
+                self.image = self.image.reduce(factor)
+
+        # unique pixels as one contiguous row per channel, and their counts
+        self._channels: np.ndarray
+        self._counts: np.ndarray
+        self._channels, self._counts = self.count_pixels(self.image)
+
+        # total weights of the unique pixels, computed once per callback
+        self._weight_cache: dict[Callable[[RGBPixel], float], np.ndarray] = {}
+
+        # scratch space reused by every level of the colour search
+        self._key_buffer = np.empty(len(self._counts), dtype=np.intp)
+        self._channel_buffer = np.empty(len(self._counts), dtype=np.intp)
+        self._mask_buffer = np.empty(len(self._counts), dtype=bool)
+
+    @staticmethod
+    def count_pixels(image: Image.Image) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Counts the occurrences of every unique pixel in an RGB image.
+
+        Returns the unique pixels as a (3, N) int32 array holding one contiguous row
+        per channel, and an (N,) array of counts. The pixels are in the order they
+        first appear in the image, so ties between equally prominent colours go to
+        the one seen first.
+        """
+        pixels = np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+
+        keys = (
+            (pixels[:, 0].astype(np.uint32) << 16)
+            | (pixels[:, 1].astype(np.uint32) << 8)
+            | pixels[:, 2]
+        )
+        unique_keys, first_seen, counts = np.unique(
+            keys, return_index=True, return_counts=True
+        )
+
+        order = np.argsort(first_seen)
+        unique_keys, counts = unique_keys[order], counts[order]
 
-        self.counter = Counter(self.image.getdata())
+        channels = np.stack(
+            [(unique_keys >> 16) & 0xFF, (unique_keys >> 8) & 0xFF, unique_keys & 0xFF]
+        ).astype(np.int32)
+
+        return channels, counts.astype(np.int64)
 
     def set_callback(self, callback: Callable[[RGBPixel], float]) -> None:
         """Sets the Callback Function to be used for Colour Detection."""
@@ -46,73 +119,98 @@ class ColorFinder:
     def get_colour(self) -> str:
         """Returns the most prominent colour based on the callback function."""
 
-        data = self.get_image_data()
-
-        rgb = self.get_most_prominent_rgb_impl(data, 6, None)
-        rgb = self.get_most_prominent_rgb_impl(data, 4, rgb)
-        rgb = self.get_most_prominent_rgb_impl(data, 2, rgb)
-        rgb = self.get_most_prominent_rgb_impl(data, 0, rgb)
-
-        hex_colour = f"#{rgb['r']:02x}{rgb['g']:02x}{rgb['b']:02x}"
+        channels = self._channels
+        weights = self.get_image_data()
+
+        # refine the colour from coarse to fine buckets in a single pass, keeping
+        # only the pixels inside the chosen bucket for the next level.
+        r, g, b = 0, 0, 0
+        prev_degrade = 8
+        for degrade in (6, 4, 2, 0):
+            bits = prev_degrade - degrade
+            best, _ = self.get_most_prominent_bucket(channels, weights, degrade, bits)
+
+            bucket_r, bucket_g, bucket_b = self.split_bucket_key(best, bits)
+            r, g, b = (
+                (r << bits) | bucket_r,
+                (g << bits) | bucket_g,
+                (b << bits) | bucket_b,
+            )
+
+            # the keys of the last histogram are still in the key buffer
+            matches = np.equal(
+                self._key_buffer[: len(weights)],
+                best,
+                out=self._mask_buffer[: len(weights)],
+            )
+            channels, weights = channels[:, matches], weights[matches]
+            prev_degrade = degrade
+
+        hex_colour = f"#{r:02x}{g:02x}{b:02x}"
 
         return hex_colour
 
-    def get_image_data(self) -> dict[RGBPixel, dict[str, int]]:
+    def get_image_data(self) -> np.ndarray:
         """
-        Gets Pixel Counts and Weights from an Image. Returns them as a dictionary.
-        Weight is calculated based on the callback function.
-
-        returns {
-            (r, g, b): {
-                "weight": int,
-                "count": int,
-            },
-            ...
-        }
+        Gets the Total Weight of every unique pixel in the Image.
+        Weight is calculated based on the callback function and multiplied by
+        the number of times the pixel occurs.
 
+        returns an (N,) int64 array aligned with the unique pixels.
+        Results are cached per callback.
         """
-        result: dict[RGBPixel, dict[str, int]] = {}
-        for pixel, count in self.counter.items():
-            result[pixel] = {
-                "weight": max(int(self.callback(pixel)), 0),
-                "count": count,
-            }
+        if self.callback in self._weight_cache:
+            return self._weight_cache[self.callback]
 
-        return result
+        callback_vec = self.vectorized_callback(self.callback)
+        if callback_vec is None:
+            callback_vec = jit_callback(self.callback)
 
-    def get_most_prominent_rgb_impl(
-        self,
-        pixels: dict[RGBPixel, dict[str, int]],
-        degrade: int,
-        rgb_match: Optional[dict[str, float]],
-    ) -> dict[str, float]:
-        """Gets the Most Prominent"""
+        if callback_vec is not None:
+            weights = callback_vec(self._channels)
+        else:
+            pixels: list[RGBPixel] = list(zip(*self._channels.tolist()))
+            weights = np.fromiter(map(self.callback, pixels), dtype=np.float64)
+
+        total_weights = (
+            np.maximum(weights.astype(np.int64, copy=False), 0) * self._counts
+        )
+        self._weight_cache[self.callback] = total_weights
 
-        rgb: dict[str, float] = {"r": 0, "g": 0, "b": 0, "weight": 0, "d": degrade}
-        db: dict[RGBPixel, float] = {}
+        return total_weights
 
-        for pixel, value in pixels.items():
-            total_weight = value["weight"] * value["count"]
-            if self.does_rgb_match(rgb_match, pixel):
-                degraded_pixel: RGBPixel = tuple(c >> degrade for c in pixel)  # type: ignore
-                db[degraded_pixel] = db.get(degraded_pixel, 0) + total_weight
+    def get_most_prominent_bucket(
+        self, channels: np.ndarray, weights: np.ndarray, degrade: int, bits: int
+    ) -> tuple[int, int]:
+        """
+        Histograms the pixels in `channels` by the `bits` of each channel above
+        `degrade` and returns the key of the heaviest bucket along with its weight.
 
-        max_weight = max(db.items(), key=lambda x: x[1])
-        rgb["r"], rgb["g"], rgb["b"] = max_weight[0]
-        rgb["weight"] = max_weight[1]
+        The bucket key of every pixel is left in the key buffer.
+        """
+        keys = self._key_buffer[: len(weights)]
+        channel = self._channel_buffer[: len(weights)]
 
-        return rgb
+        keys.fill(0)
+        for values in channels:
+            np.right_shift(values, degrade, out=channel)
+            np.bitwise_and(channel, (1 << bits) - 1, out=channel)
+            np.left_shift(keys, bits, out=keys)
+            np.bitwise_or(keys, channel, out=keys)
 
-    def does_rgb_match(
-        self, reference: Optional[dict[str, float]], pixel: RGBPixel
-    ) -> bool:
-        """Checks if the RGB values in `pixel` match the RGB values in `reference` after degrade."""
-        if reference is None:
-            return True
+        histogram = np.bincount(keys, weights=weights, minlength=1 << (3 * bits))
 
-        r, g, b = (c >> int(reference["d"]) for c in pixel)
+        # only buckets holding a pixel are candidates, even when every weight is zero,
+        # and ties go to the bucket of the pixel listed first
+        best = int(keys[histogram[keys].argmax()])
 
-        return reference["r"] == r and reference["g"] == g and reference["b"] == b
+        return best, int(histogram[best])
+
+    @staticmethod
+    def split_bucket_key(key: int, bits: int) -> RGBPixel:
+        """Splits a bucket key packed with `bits` per channel into (r, g, b)."""
+        mask = (1 << bits) - 1
+        return (key >> (2 * bits)) & mask, (key >> bits) & mask, key & mask
 
     @staticmethod
     def get_dark_light_colours(image: Image.Image) -> tuple[str, str]:
@@ -141,62 +239,178 @@ class ColorFinder:
     @staticmethod
     def favour_bright_exclude_white(pixel: RGBPixel) -> float:
         """A Callback Function that Favours Bright Colors and Excludes White."""
-
-        r, g, b = pixel
-        if r > 245 and g > 245 and b > 245:
-            return 0
-        return (r * r + g * g + b * b) / 65535 * 20 + 1
+        return float(
+            ColorFinder.favour_bright_exclude_white_vec(np.array(pixel).reshape(3, 1))[
+                0
+            ]
+        )
 
     @staticmethod
     def favour_dark(pixel: RGBPixel) -> float:
         """A Callback Function that Favours Dark Colors."""
-        r, g, b = pixel
-        return 768 - r - g - b + 1
+        return float(ColorFinder.favour_dark_vec(np.array(pixel).reshape(3, 1))[0])
 
     @staticmethod
     def favour_hue(pixel: RGBPixel) -> float:
         """A Callback Function that Favours Hue."""
-        r, g, b = pixel
-        return (
-            abs(r - g) * abs(r - g) + abs(r - b) * abs(r - b) + abs(g - b) * abs(g - b)
-        ) / 65535 * 50 + 1
+        return float(ColorFinder.favour_hue_vec(np.array(pixel).reshape(3, 1))[0])
 
     @staticmethod
     def favour_saturation(pixel: RGBPixel) -> float:
         """A Callback Function that Favours Saturation."""
-        max_value: float = max(pixel) / 255
-        min_value: float = min(pixel) / 255
-        luminosity: float = max_value - min_value
+        return float(
+            ColorFinder.favour_saturation_vec(np.array(pixel).reshape(3, 1))[0]
+        )
 
-        if luminosity == 0:
-            saturation = 0.0
-        elif luminosity < 0.5:
-            saturation = luminosity / (max_value + min_value)
-        elif luminosity > 0.5:
-            saturation = luminosity / (2 - max_value - min_value)
+    @staticmethod
+    def favour_bright_exclude_white_vec(channels: np.ndarray) -> np.ndarray:
+        """Vectorized `favour_bright_exclude_white` over a (3, N) array of channels."""
+        r, g, b = channels.astype(np.int32, copy=False)
+
+        # integer floor division gives the same whole weights as scaling the float
+        weights = (r * r + g * g + b * b) * 20 // 65535 + 1
+        weights[(r > 245) & (g > 245) & (b > 245)] = 0
 
-        return saturation
+        return weights
+
+    @staticmethod
+    def favour_dark_vec(channels: np.ndarray) -> np.ndarray:
+        """Vectorized `favour_dark` over a (3, N) array of channels."""
+        r, g, b = channels.astype(np.int32, copy=False)
+        return 768 - r - g - b + 1
+
+    @staticmethod
+    def favour_hue_vec(channels: np.ndarray) -> np.ndarray:
+        """Vectorized `favour_hue` over a (3, N) array of channels."""
+        r, g, b = channels.astype(np.int32, copy=False)
+        d_rg, d_rb, d_gb = r - g, r - b, g - b
+        return (d_rg * d_rg + d_rb * d_rb + d_gb * d_gb) * 50 // 65535 + 1
+
+    @staticmethod
+    def favour_saturation_vec(channels: np.ndarray) -> np.ndarray:
+        """Vectorized `favour_saturation` over a (3, N) array of channels."""
+        max_value = channels.max(axis=0) / 255
+        min_value = channels.min(axis=0) / 255
+        luminosity = max_value - min_value
+
+        denominator = np.where(
+            luminosity < 0.5, max_value + min_value, 2 - max_value - min_value
+        )
+
+        # the denominator is only zero for black, where the luminosity is zero too
+        return np.where(
+            luminosity == 0, 0.0, luminosity / np.maximum(denominator, 1e-9)
+        )
+
+    @staticmethod
+    def vectorized_callback(
+        callback: Callable[[RGBPixel], float],
+    ) -> Optional[Callable[[np.ndarray], np.ndarray]]:
+        """Returns the vectorized version of a built-in callback if there is one."""
+        vectorized: dict[
+            Callable[[RGBPixel], float], Callable[[np.ndarray], np.ndarray]
+        ] = {
+            ColorFinder.favour_bright_exclude_white: ColorFinder.favour_bright_exclude_white_vec,
+            ColorFinder.favour_dark: ColorFinder.favour_dark_vec,
+            ColorFinder.favour_hue: ColorFinder.favour_hue_vec,
+            ColorFinder.favour_saturation: ColorFinder.favour_saturation_vec,
+        }
+        return vectorized.get(callback)
+
+
+def jit_callback(
+    callback: Callable[[RGBPixel], float],
+) -> Optional[Callable[[np.ndarray], np.ndarray]]:
+    """
+    Compiles a custom callback with numba into a kernel over a (3, N) array of channels.
+    Returns None if numba is not installed or cannot compile the callback, in which
+    case the callback is run in Python.
+
+    A callback is only compiled the second time it is seen, as compiling takes longer
+    than running a callback in Python once, and a new lambda or closure per image
+    would never reuse its kernel. Kernels are then cached while the callback lives.
+    """
+    # numba only compiles plain functions, not methods or other callables
+    if not inspect.isfunction(callback):
+        return None
+
+    if callback in _JIT_KERNELS:
+        return _JIT_KERNELS[callback]
+
+    if callback not in _SEEN_CALLBACKS:
+        _SEEN_CALLBACKS.add(callback)
+        return None
+
+    _JIT_KERNELS[callback] = None
+
+    # numba is optional and slow to import, so only load it for a custom callback
+    try:
+        import numba
+    except ImportError:
+        return None
+
+    try:
+        jitted = numba.njit(callback)
+
+        @numba.njit
+        def kernel(channels: np.ndarray) -> np.ndarray:
+            weights = np.empty(channels.shape[1], dtype=np.float64)
+            for i in range(channels.shape[1]):
+                weights[i] = jitted(
+                    (int(channels[0, i]), int(channels[1, i]), int(channels[2, i]))
+                )
+            return weights
+
+        # compile for the unique pixel channels without calling the callback, so
+        # unsupported callbacks fall back to Python and its own errors still surface
+        kernel.compile("(int32[:, ::1],)")
+    except (TypeError, numba.core.errors.NumbaError):
+        return None
+
+    _JIT_KERNELS[callback] = kernel
+
+    return kernel
+
+
+def contrast_lut(image: Image.Image, contrast_factor: float) -> list[int]:
+    """
+    Returns a 256 entry lookup table that matches `ImageEnhance.Contrast(image)`
+    enhanced by `contrast_factor`, for use with `Image.point`.
+    """
+    mean = np.float32(int(ImageStat.Stat(image.convert("L")).mean[0] + 0.5))
+    values = np.arange(256, dtype=np.float32)
+
+    # same single precision blend against the mean as Pillow, truncated to uint8
+    blended = mean + np.float32(contrast_factor) * (values - mean)
+
+    return np.clip(blended, 0, 255).astype(np.uint8).tolist()
 
 
 def colour_correct_image(
-    image_path: PathLike,
+    image: PathLike | Image.Image,
     contrast_factor: float = 1.3,
-    brightness_factor: float = 1.1,
 ) -> io.BytesIO:
-    """Increases the Brightness of an Image."""
-    if not Path(image_path).exists():
-        raise FileNotFoundError(f"Image File Not Found: {image_path}")
+    """
+    Increases the Contrast of an Image and Returns it Encoded as a PNG.
 
-    img = Image.open(image_path).convert("RGB")
+    `image` is either the path to an image or an already decoded image.
+    """
+    if not isinstance(image, Image.Image):
+        if not Path(image).exists():
+            raise FileNotFoundError(f"Image File Not Found: {image}")
 
-    contrast_enhancer = ImageEnhance.Contrast(img)
-    brightness_enhancer = ImageEnhance.Brightness(img)
+        image = Image.open(image)
 
-    img = contrast_enhancer.enhance(contrast_factor)
-    img = brightness_enhancer.enhance(brightness_factor)
-    img = contrast_enhancer.enhance(contrast_factor)
+    img = enhance_contrast(image, contrast_factor)
 
+    # the buffer is usually decoded again straight away, so favour speed over size
     img_bytes = io.BytesIO()
-    img.save(img_bytes, format="PNG")
+    img.save(img_bytes, format="PNG", compress_level=1)
 
     return img_bytes
+
+
+def enhance_contrast(image: Image.Image, contrast_factor: float = 1.3) -> Image.Image:
+    """Increases the Contrast of an Image, Returning it in RGB."""
+    img = image if image.mode == "RGB" else image.convert("RGB")
+    return img.point(contrast_lut(img, contrast_factor) * len(img.getbands()))
@@ -4,15 +4,18 @@ Main entry file that orchastrates QR code generation.
 Author: Mohammed Alkhateeb (@MoAlkhateeb)
 """
 
+import os
 import sys
 import csv
+import mmap
 import pprint
 import warnings
 import configparser
 from pathlib import Path
-from typing import TypedDict
-from multiprocessing import freeze_support
-from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Optional, TypedDict
+from multiprocessing.context import BaseContext
+from multiprocessing import freeze_support, get_all_start_methods, get_context
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 
 from tqdm import tqdm
 
@@ -24,7 +27,8 @@ PathLike = str | Path
 warnings.simplefilter("ignore", UserWarning)
 
 IS_FROZEN = getattr(sys, "frozen", False)
-SUPPORTED_IMAGE_FORMATS = [".png", ".jpg", ".jpeg"]
+BATCH_SIZE = 500
+SUPPORTED_IMAGE_FORMATS = (".png", ".jpg", ".jpeg")
 BAR_FORMAT = "{l_bar}{bar} | {n_fmt}/{total_fmt} [ETA: {remaining}, Elapsed: {elapsed}, {rate_fmt}]"
 
 
@@ -68,19 +72,113 @@ def read_config(config_path: PathLike) -> Config:
     )
 
 
-def helper(arguments: tuple[PathLike, Config]) -> Path:
-    """Helper Function to Generate QR Code for Multiple Images."""
-    return generate_qr_code(*arguments)
+# the configuration and marker SVG shared by every task, installed once per worker
+_WORKER_CONF: Optional[Config] = None
+_WORKER_MARKER_SVG: Optional[bytes] = None
 
 
-def generate_qr_code(image_path: PathLike, conf: Config) -> Path:
-    """Creates a QR Code for the Image and Saves it in the Output Path."""
+def init_worker(conf: Config, marker_svg: Optional[bytes] = None) -> None:
+    """Installs the Shared Configuration and Marker SVG in a Worker Process."""
+    global _WORKER_CONF, _WORKER_MARKER_SVG
+    _WORKER_CONF = conf
+    _WORKER_MARKER_SVG = marker_svg
 
+
+def helper(arguments: tuple[str, Optional[str]]) -> Path:
+    """
+    Helper Function to Generate QR Code for Multiple Images.
+
+    `arguments` is the image path and an optional URL overriding the shared one.
+    """
+    if _WORKER_CONF is None:
+        raise RuntimeError("Worker Configuration Not Initialized.")
+
+    image_path, url = arguments
+
+    conf = _WORKER_CONF
+    if url is not None:
+        conf = conf.copy()
+        conf["url"] = url
+
+    return generate_qr_code(image_path, conf, _WORKER_MARKER_SVG)
+
+
+def chunk_helper(chunk: list[tuple[str, Optional[str]]]) -> list[Path]:
+    """Helper Function to Generate QR Codes for a Chunk of Images in one Task."""
+    return [helper(arguments) for arguments in chunk]
+
+
+def generate_in_pool(
+    executor: ProcessPoolExecutor,
+    request_list: list[tuple[str, Optional[str]]],
+    chunksize: int,
+    max_pending: int,
+) -> Iterator[list[Path]]:
+    """
+    Yields the Save Paths of each Chunk of Requests as soon as it Completes.
+
+    At most `max_pending` chunks are queued at once, so a slow image does not hold
+    back the results of the ones after it.
+    """
+    pending: set[Future[list[Path]]] = set()
+
+    for start in range(0, len(request_list), chunksize):
+        chunk = request_list[start : start + chunksize]
+        pending.add(executor.submit(chunk_helper, chunk))
+
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def generate_in_batches(
+    request_list: list[tuple[str, Optional[str]]],
+    conf: Config,
+    marker_svg: Optional[bytes],
+    workers: int,
+) -> Iterator[list[Path]]:
+    """
+    Yields the Save Paths of each Chunk of Requests as soon as it Completes.
+
+    Requests are handled `BATCH_SIZE` at a time, each batch by a fresh pool, so the
+    memory held by the workers can't grow with the number of images.
+    """
+    for start in range(0, len(request_list), BATCH_SIZE):
+        batch = request_list[start : start + BATCH_SIZE]
+
+        # hand each worker a few images at a time to cut down on IPC round-trips
+        chunksize = max(1, len(batch) // (workers * 4))
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=pool_context(),
+            initializer=init_worker,
+            initargs=(conf, marker_svg),
+        ) as executor:
+            yield from generate_in_pool(executor, batch, chunksize, 2 * workers)
+
+
+def generate_qr_code(
+    image_path: PathLike, conf: Config, marker_svg: Optional[bytes] = None
+) -> Path:
+    """
+    Creates a QR Code for the Image and Saves it in the Output Path.
+
+    `marker_svg` is the already read custom marker SVG, read from the config if None.
+    """
+
+    marker: Optional[PathLike | bytes]
     if conf["custom_marker"]:
-        marker_path = conf["custom_marker_svg"]
-        marker_name = marker_path.stem
+        marker = conf["custom_marker_svg"] if marker_svg is None else marker_svg
+        marker_name = conf["custom_marker_svg"].stem
     else:
-        marker_path = None
+        marker = None
         marker_name = "default"
 
     save_path = conf["output_path"] / f"QR_{marker_name}_{Path(image_path).stem}.png"
@@ -90,7 +188,7 @@ def generate_qr_code(image_path: PathLike, conf: Config) -> Path:
     code.create_qr_code_image(
         image_path,
         dynamic_colours=True,
-        custom_finder_marker_svg=marker_path,
+        custom_finder_marker_svg=marker,
     )
 
     code.save(save_path)
@@ -101,48 +199,58 @@ def generate_qr_code(image_path: PathLike, conf: Config) -> Path:
 def generate_qr_codes(conf: Config) -> None:
     """Generate all qr codes for image in input_path and saves them in output_path."""
 
-    request_list = []
+    request_list: list[tuple[str, Optional[str]]] = []
 
     if not conf["use_batch"]:
         for image in find_images(conf["input_path"]):
-            request_list.append((image, conf))
+            request_list.append((str(image), None))
     else:
-        with open(conf["batch_path"], "r", encoding="utf-8") as batch_f:
-            reader = csv.reader(batch_f)
-
-            for row in reader:
-                if len(row) < 2:
-                    print("Malformed row in batch file skipping: ", row)
-                    continue
+        for row in read_batch_file(conf["batch_path"]):
+            if len(row) < 2:
+                print("Malformed row in batch file skipping: ", row)
+                continue
 
-                rel_path, url = row
-                rel_path = rel_path.strip()
-                url = url.strip()
+            rel_path, url = row
+            rel_path = rel_path.strip()
+            url = url.strip()
 
-                rel_path: Path = conf["input_path"] / rel_path
+            rel_path: Path = conf["input_path"] / rel_path
 
-                if not rel_path.is_file():
-                    print(f"Couldn't find the image at '{rel_path}'.")
-                    print("Ensure paths in batch file are relative to the input folder")
-                    continue
+            if not rel_path.is_file():
+                print(f"Couldn't find the image at '{rel_path}'.")
+                print("Ensure paths in batch file are relative to the input folder")
+                continue
 
-                current_conf = conf.copy()
-                current_conf["url"] = url
-
-                request_list.append((rel_path, current_conf))
+            request_list.append((str(rel_path), url))
 
     print("Number of Images: ", len(request_list), "\n")
 
     save_paths: list[Path] = []
 
+    workers = min(worker_count(), len(request_list))
+
+    # read the marker once here rather than in every worker
+    marker_svg = None
+    if conf["custom_marker"]:
+        qr_code.validate_svg_path(conf["custom_marker_svg"])
+        marker_svg = conf["custom_marker_svg"].read_bytes()
+
+    results: Iterator[list[Path]]
+
+    if len(request_list) > 1:
+        results = generate_in_batches(request_list, conf, marker_svg, workers)
+    else:
+        # a single QR code is quicker to generate here than to hand to new processes
+        init_worker(conf, marker_svg)
+        results = map(chunk_helper, [request_list])
+
     with tqdm(
         total=len(request_list),
         bar_format=BAR_FORMAT,
     ) as pbar:
-        with ProcessPoolExecutor() as executor:
-            for save_path in executor.map(helper, request_list):
-                pbar.update()
-                save_paths.append(save_path)
+        for chunk_save_paths in results:
+            pbar.update(len(chunk_save_paths))
+            save_paths.extend(chunk_save_paths)
 
     print("\n")
     print_heading("Generated QR Codes")
@@ -151,6 +259,58 @@ def generate_qr_codes(conf: Config) -> None:
     print()
 
 
+def read_batch_file(batch_path: Path) -> Iterator[list[str]]:
+    """Reads the Rows of a Batch File through a Read-Only Memory Map."""
+
+    # an empty file can't be memory mapped
+    if batch_path.stat().st_size == 0:
+        return
+
+    with open(batch_path, "rb") as batch_f:
+        with mmap.mmap(batch_f.fileno(), 0, access=mmap.ACCESS_READ) as batch_map:
+            lines = (line.decode("utf-8") for line in iter(batch_map.readline, b""))
+            yield from csv.reader(lines)
+
+
+def worker_count() -> int:
+    """
+    Returns the Number of Worker Processes to Use.
+
+    Defaults to the CPUs this process may run on, and can be overridden with the
+    `QR_WORKERS` environment variable.
+    """
+    workers = os.environ.get("QR_WORKERS")
+    if workers:
+        try:
+            if int(workers) <= 0:
+                raise ValueError
+
+            return int(workers)
+        except ValueError:
+            print(f"Invalid QR_WORKERS Value '{workers}'. Using the CPU Count.")
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def pool_context() -> BaseContext:
+    """
+    Returns the Multiprocessing Context for the Worker Pool.
+
+    Workers are forked from a server process that has already imported the QR code
+    modules, so each starts without copying this process or importing them again.
+    Frozen executables and platforms without a fork server spawn fresh workers.
+    """
+    if IS_FROZEN or "forkserver" not in get_all_start_methods():
+        return get_context("spawn")
+
+    context = get_context("forkserver")
+    context.set_forkserver_preload(["qr_code"])
+    return context
+
+
 def print_heading(heading: str) -> None:
     """Prints a Heading with a Border of Asterisks"""
     print("\n")
@@ -162,11 +322,12 @@ def print_heading(heading: str) -> None:
 
 def find_images(input_path: Path) -> list[Path]:
     """Finds all Images in the Input Path"""
-    return [
-        image
-        for image in input_path.iterdir()
-        if image.suffix.lower() in SUPPORTED_IMAGE_FORMATS
-    ]
+    with os.scandir(input_path) as entries:
+        return [
+            input_path / entry.name
+            for entry in entries
+            if entry.name.lower().endswith(SUPPORTED_IMAGE_FORMATS)
+        ]
 
 
 def main() -> None:
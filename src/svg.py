@@ -5,49 +5,65 @@ Author: Mohammed Alkhateeb (@MoAlkhateeb)
 """
 
 import io
+import copy
 from pathlib import Path
-from typing import Optional
-from xml.dom import minidom
-from PIL import Image
+from typing import Optional, cast
 
 import pyvips
+from lxml import etree
 
 PathLike = str | Path
 
+# external entities and DTDs are never fetched when parsing SVGs
+PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
 
 class SVG:
     """Custom SVG Class."""
 
-    def __init__(self, svg_path: PathLike) -> None:
-        if not Path(svg_path).exists():
-            raise FileNotFoundError(f"SVG File Not Found: {svg_path}")
+    def __init__(self, svg_source: PathLike | bytes) -> None:
+        """Creates an SVG from a File Path or from the Contents of an SVG File."""
+        self.svg_path: Optional[PathLike] = None
 
-        self.svg_path: PathLike = svg_path
-        self.svg: minidom.Document = self.read()
+        if isinstance(svg_source, bytes):
+            self.svg: etree._ElementTree = parse_svg(io.BytesIO(svg_source))
+            return
 
-    def read(self) -> minidom.Document:
-        """Reads an SVG File and Returns a minidom Document."""
-        return minidom.parse(str(self.svg_path))
+        if not Path(svg_source).exists():
+            raise FileNotFoundError(f"SVG File Not Found: {svg_source}")
 
-    def to_image(self, width: int, height: int) -> Image.Image:
-        """Saves the SVG as a PNG."""
+        self.svg_path = svg_source
+        self.svg = self.read()
 
-        image = pyvips.Image.thumbnail_buffer(
-            self.svg.toxml().encode(), width, height=height, size="force"
-        )
+    def read(self) -> etree._ElementTree:
+        """Reads an SVG File and Returns an lxml Element Tree."""
+        if self.svg_path is None:
+            raise ValueError("SVG Was Not Created From a File.")
+
+        return parse_svg(str(self.svg_path))
+
+    def copy(self) -> "SVG":
+        """Returns a Deep Copy of the SVG."""
+        clone = SVG.__new__(SVG)
+        clone.svg_path = self.svg_path
+        clone.svg = copy.deepcopy(self.svg)
+        return clone
 
-        image_bytes = image.write_to_buffer(".png")
-        return Image.open(io.BytesIO(image_bytes))
+    def to_vips_image(self, width: int, height: int) -> pyvips.Image:
+        """Renders the SVG as a pyvips Image."""
+        return pyvips.Image.thumbnail_buffer(
+            etree.tostring(self.svg), width, height=height, size="force"
+        )
 
     def save(self, save_path: PathLike) -> None:
         """Saves the SVG to a File."""
-        with open(save_path, "w", encoding="utf-8") as file:
-            file.write(self.svg.toprettyxml())
+        self.svg.write(
+            str(save_path), encoding="utf-8", pretty_print=True, xml_declaration=True
+        )
 
     def save_png(self, save_path: PathLike, width: int, height: int) -> None:
         """Saves the SVG as a PNG."""
-        image = self.to_image(width, height)
-        image.save(save_path)
+        self.to_vips_image(width, height).write_to_file(str(save_path))
 
     def set_attribute(
         self, attribute: str, value: str, condition: Optional[str] = None
@@ -57,26 +73,24 @@ class SVG:
         If `condition` is provided, only the elements with the `attribute` value equal
         to `condition` will be replaced.
         """
-        elements = self.svg.getElementsByTagName("*")
+        if condition is None:
+            result = self.svg.xpath(f"//*[@{attribute}]")
+        else:
+            result = self.svg.xpath(
+                f"//*[@{attribute}=$condition]", condition=condition
+            )
+
+        # an element path always selects a list of elements
+        elements = cast(list[etree._Element], result)
 
         for element in elements:
-            if not element.hasAttribute(attribute):
-                continue
-
-            if condition is not None and element.getAttribute(attribute) != condition:
-                continue
-
-            element.setAttribute(attribute, value)
-
-    @staticmethod
-    def overlay_svg_on_image(
-        svg: "SVG",
-        image: Image.Image,
-        position: tuple[int, int],
-        width: int,
-        height: int,
-    ) -> Image.Image:
-        """Overlays an SVG on an Image at a Specified Position."""
-        svg_image = svg.to_image(width, height)
-        image.paste(svg_image, position, svg_image)
-        return image
+            element.set(attribute, value)
+
+
+def parse_svg(source: str | io.BytesIO) -> etree._ElementTree:
+    """Parses an SVG File, Raising a ValueError if it is not Well-Formed."""
+    try:
+        return etree.parse(source, PARSER)
+    except etree.XMLSyntaxError as error:
+        # lxml's own error can't be pickled back from a worker process
+        raise ValueError(f"Invalid SVG: {error}") from error
@@ -0,0 +1,60 @@
+"""
+Tests for the Colour Finder.
+
+Run from the repository root with `python -m unittest discover tests`.
+"""
+
+import sys
+import unittest
+from pathlib import Path
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import colour_finder
+
+
+def red_ratio(pixel: colour_finder.RGBPixel) -> float:
+    """A Callback that Divides by the Channel Sum, so it Fails on Black."""
+    r, g, b = pixel
+    return r / (r + g + b) * 100
+
+
+def blue_ratio(pixel: colour_finder.RGBPixel) -> float:
+    """A Callback that Divides by the Channel Sum, so it Fails on Black."""
+    r, g, b = pixel
+    return b / (r + g + b) * 100
+
+
+class TestColorFinder(unittest.TestCase):
+    """Tests for `colour_finder.ColorFinder`."""
+
+    def test_division_callback_without_black_pixels(self) -> None:
+        """A Custom Callback is only Run on Pixels in the Image."""
+        image = Image.new("RGB", (16, 16), (200, 30, 40))
+
+        # a callback runs in Python when first seen and is compiled when used again
+        for _ in range(3):
+            finder = colour_finder.ColorFinder(image, red_ratio)
+            self.assertEqual(finder.get_colour(), "#c81e28")
+
+    def test_callback_errors_surface(self) -> None:
+        """Errors Raised by a Custom Callback are not Swallowed."""
+        image = Image.new("RGB", (16, 16), (0, 0, 0))
+
+        for _ in range(3):
+            finder = colour_finder.ColorFinder(image, blue_ratio)
+            with self.assertRaises(ZeroDivisionError):
+                finder.get_colour()
+
+    def test_max_pixels_must_be_positive(self) -> None:
+        """A Zero Pixel Target is Rejected Rather than Dividing by Zero."""
+        image = Image.new("RGB", (16, 16), (200, 30, 40))
+
+        with self.assertRaises(ValueError):
+            colour_finder.ColorFinder(image, max_pixels=0)
+
+
+if __name__ == "__main__":
+    unittest.main()